@@ -1,32 +1,38 @@
-from fastapi import FastAPI, UploadFile, Form, HTTPException
+from fastapi import FastAPI, UploadFile, Form, HTTPException, Depends
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, StreamingResponse
-from sqlalchemy import Column, Integer, String, DateTime, Text, JSON
+from fastapi.responses import JSONResponse, Response
+from sqlalchemy import Column, Integer, String, DateTime, Text, JSON, ForeignKey, Index, UniqueConstraint, func
+from sqlalchemy.dialects.mysql import insert as mysql_insert
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy import create_engine
-from PIL import Image
+from sqlalchemy.orm import sessionmaker, Session
+from sqlalchemy import create_engine, inspect, select, update
+from sqlalchemy.schema import AddConstraint
 from datetime import datetime
+from typing import Any
+from contextlib import asynccontextmanager
 from dotenv import load_dotenv
 import os
-import fitz
-import numpy as np
-import cv2
 import s3_utils
+import pdf_utils
 import logging
 import json
-import io
+import orjson
+import asyncio
+import tempfile
 
 # --- Immediate debug print ---
 # print("Starting execution in", os.path.abspath(__file__))
 
-# --- Test logging at module level ---
-logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
-logger = logging.getLogger(__name__)
-logger.info("Logger initialized successfully in %s", os.path.abspath(__file__))
-
 # --- Load .env ---
 load_dotenv()
+
+# --- Logging ---
+# SQLAlchemy logs every statement whenever its logger is INFO-enabled, even
+# with echo=False, so keep it at WARNING unless SQL_LOG is set.
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper(), format='%(asctime)s - %(levelname)s - %(message)s')
+logging.getLogger("sqlalchemy.engine").setLevel(logging.INFO if os.getenv("SQL_LOG") else logging.WARNING)
+logger = logging.getLogger(__name__)
+logger.info("Logger initialized successfully in %s", os.path.abspath(__file__))
 DB_USERNAME = os.getenv("DB_USERNAME")
 DB_PASSWORD = os.getenv("DB_PASSWORD")
 DB_HOST = os.getenv("DB_HOST")
@@ -42,12 +48,32 @@ if not all([S3_BUCKET_NAME, S3_BUCKET_ACCESS_KEY, S3_BUCKET_SECRET_KEY]):
 # --- Database setup ---
 DATABASE_URL = f"mysql+pymysql://{DB_USERNAME}:{DB_PASSWORD}@{DB_HOST}/{DB_NAME}"
 Base = declarative_base()
-engine = create_engine(DATABASE_URL, echo=True)
+engine = create_engine(
+    DATABASE_URL,
+    echo=False,
+    pool_size=20,
+    pool_pre_ping=True,
+    pool_recycle=3600,
+    # orjson is several times faster than the stdlib for the image_urls column
+    json_serializer=lambda obj: orjson.dumps(obj).decode(),
+    json_deserializer=orjson.loads
+)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
-# --- Updated Model with single JSON column ---
+def get_db():
+    """Yields a session for the duration of a request"""
+    db = SessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
+# --- Models: one row per module, one child row per crop URL ---
 class PDFCropImages(Base):
     __tablename__ = "pdf_crop_images1"
+    __table_args__ = (
+        UniqueConstraint("class_id", "subject_id", "course_id", "module_id", name="uq_pdf_crop_images1_module"),
+    )
     
     id = Column(Integer, primary_key=True, index=True)
     class_id = Column(Integer, nullable=False)
@@ -55,7 +81,8 @@ class PDFCropImages(Base):
     course_id = Column(Integer, nullable=False)
     module_id = Column(Integer, nullable=False)
     
-    # Single JSON column to store all categories and their URLs
+    # Legacy JSON column, no longer written. URLs saved before pdf_crop_urls
+    # existed still live here and are merged into responses on read.
     # Structure: {
     #   "tables": ["url1", "url2"],
     #   "equations": ["url3", "url4"],
@@ -67,11 +94,89 @@ class PDFCropImages(Base):
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
-# Create table if not exists
-Base.metadata.create_all(bind=engine)
+class PDFCropURL(Base):
+    __tablename__ = "pdf_crop_urls"
+    __table_args__ = (
+        Index("ix_pdf_crop_urls_parent_category", "parent_id", "category"),
+    )
+
+    id = Column(Integer, primary_key=True)
+    parent_id = Column(Integer, ForeignKey("pdf_crop_images1.id", ondelete="CASCADE"), nullable=False)
+    category = Column(String(32), nullable=False)
+    url = Column(Text, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+CROP_MODULE_KEY = ("class_id", "subject_id", "course_id", "module_id")
+
+def ensure_crop_schema():
+    """Adds the unique key save_crop's upsert relies on to pdf_crop_images1 if it is missing"""
+    # create_all never alters an existing table; without the key every
+    # ON DUPLICATE KEY upsert would silently insert another module row.
+    table = PDFCropImages.__table__
+    inspector = inspect(engine)
+    keys = inspector.get_unique_constraints(table.name)
+    keys += [index for index in inspector.get_indexes(table.name) if index.get("unique")]
+    if any(set(key["column_names"]) == set(CROP_MODULE_KEY) for key in keys):
+        return
+
+    key_columns = [table.c[name] for name in CROP_MODULE_KEY]
+    with engine.begin() as conn:
+        duplicates = conn.execute(
+            select(*key_columns, func.count()).group_by(*key_columns).having(func.count() > 1)
+        ).all()
+        if duplicates:
+            # Merging is a data decision (which row's URLs and dates win), so
+            # it is left to a human rather than done at startup
+            raise RuntimeError(
+                f"{table.name} is missing the unique key on {CROP_MODULE_KEY} and has "
+                f"{len(duplicates)} duplicated modules, e.g. {tuple(duplicates[0][:-1])}. "
+                "Merge them, then restart to add the key."
+            )
+        logger.info("Adding unique key %s to %s", CROP_MODULE_KEY, table.name)
+        # isolate_from_table=False keeps create_all emitting the key inline
+        conn.execute(AddConstraint(
+            next(c for c in table.constraints if isinstance(c, UniqueConstraint)),
+            isolate_from_table=False
+        ))
 
 # --- FastAPI app ---
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Create tables if not exists; done at startup rather than on import so
+    # importing the module never blocks on DDL
+    await asyncio.to_thread(Base.metadata.create_all, bind=engine)
+    await asyncio.to_thread(ensure_crop_schema)
+    yield
+    pdf_utils.close_all_docs()
+    engine.dispose()
+
+# JSON endpoints declare their return type, which lets FastAPI serialize
+# straight to bytes with pydantic-core instead of jsonable_encoder + json.dumps
+app = FastAPI(lifespan=lifespan)
+
+class UploadSizeLimit:
+    """Refuses oversized /upload-pdf requests from their Content-Length header"""
+    # Rejects before the multipart body is parsed; save_upload still enforces
+    # the cap for chunked uploads. Plain ASGI rather than @app.middleware so
+    # every other request, e.g. cached /get-page hits, passes straight through.
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"] == "/upload-pdf":
+            for name, value in scope["headers"]:
+                if name == b"content-length":
+                    if value.isdigit() and int(value) > MAX_UPLOAD_BYTES:
+                        response = JSONResponse(status_code=413, content={"detail": "PDF exceeds the upload size limit"})
+                        await response(scope, receive, send)
+                        return
+                    break
+        await self.app(scope, receive, send)
+
+# Added before CORS so it sits inside it and the 413 still carries CORS headers
+app.add_middleware(UploadSizeLimit)
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -83,6 +188,20 @@ app.add_middleware(
 
 UPLOAD_DIR = "uploaded-pdfs"
 os.makedirs(UPLOAD_DIR, exist_ok=True)
+UPLOAD_CHUNK_SIZE = 1 << 20
+MAX_UPLOAD_BYTES = 200 << 20
+
+# mkstemp creates files as 0600; uploads get the mode open() would have
+# given them. The umask is read once here because reading it means setting it.
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+UPLOAD_FILE_MODE = 0o666 & ~_UMASK
+
+# Rendering itself is serialized on pdf_utils' single fitz thread; prefetch
+# additionally encodes at most one page per CPU at a time so warming the
+# cache with several huge pages cannot blow up memory
+MAX_PREFETCH_PAGES = 10
+_render_semaphore = asyncio.Semaphore(os.cpu_count() or 1)
 
 # --- Utility functions ---
 def get_default_image_urls_structure():
@@ -94,43 +213,140 @@ def get_default_image_urls_structure():
         "others": []
     }
 
-def render_page(pdf_path, page_num, zoom=2):
-    doc = fitz.open(pdf_path)
-    page = doc.load_page(page_num)
-    pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom))
-    img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
-    doc.close()
-    return np.array(img)
+def merge_image_urls(record, rows):
+    """Combines a record's legacy JSON URLs with its (category, url) child rows"""
+    image_urls = get_default_image_urls_structure()
+    for category, urls in (record.image_urls or {}).items():
+        image_urls.setdefault(category, []).extend(urls)
+    for category, url in rows:
+        image_urls.setdefault(category, []).append(url)
+    return image_urls
+
+def upsert_crop_parent(db, class_id, subject_id, course_id, module_id):
+    """Inserts the module row if it is missing, commits and returns its id"""
+    # LAST_INSERT_ID(id) makes MySQL report the existing id on a duplicate,
+    # so both cases take a single round-trip. The upsert leaves an existing
+    # row untouched, so it commits right away instead of holding the row lock
+    # through the S3 upload. If that upload then fails, a new module keeps an
+    # empty row, which the read endpoints report like a missing one.
+    upsert = mysql_insert(PDFCropImages).values(
+        class_id=class_id,
+        subject_id=subject_id,
+        course_id=course_id,
+        module_id=module_id
+    ).on_duplicate_key_update(
+        id=func.last_insert_id(PDFCropImages.id)
+    )
+    try:
+        parent_id = db.execute(upsert).lastrowid
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    return parent_id
+
+def add_crop_url(db, parent_id, category, url):
+    """Adds one crop URL under the module row, bumps its updated_at and commits"""
+    # Each crop is one narrow row; the parent only gets its timestamp moved,
+    # so updated_at changes only when a URL is actually saved
+    try:
+        db.add(PDFCropURL(parent_id=parent_id, category=category, url=url))
+        db.execute(
+            update(PDFCropImages).where(PDFCropImages.id == parent_id).values(updated_at=datetime.utcnow())
+        )
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+
+async def warm_page(pdf_path, page_num):
+    """Renders a page into the page cache from a worker thread"""
+    async with _render_semaphore:
+        await asyncio.to_thread(pdf_utils.get_page_bytes, pdf_path, page_num)
+
+def save_upload(src, save_path):
+    """Streams an uploaded file to disk, replacing save_path atomically"""
+    # Writing to a temp file first means a cached doc that still has the old
+    # file open never sees a half-written PDF.
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(save_path), suffix=".part")
+    try:
+        os.fchmod(fd, UPLOAD_FILE_MODE)
+        written = 0
+        with os.fdopen(fd, "wb") as f:
+            while chunk := src.read(UPLOAD_CHUNK_SIZE):
+                written += len(chunk)
+                if written > MAX_UPLOAD_BYTES:
+                    raise HTTPException(status_code=413, detail="PDF exceeds the upload size limit")
+                f.write(chunk)
+        os.replace(tmp_path, save_path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
 
 # --- API Endpoints ---
 
 @app.post("/upload-pdf")
-async def upload_pdf(file: UploadFile):
+async def upload_pdf(file: UploadFile) -> dict[str, Any]:
     if not file.filename.endswith('.pdf'):
         raise HTTPException(status_code=422, detail="Only PDF files are allowed")
+    # The extension is only a hint; check the magic bytes before copying
+    if not (await file.read(5)).startswith(b"%PDF-"):
+        raise HTTPException(status_code=422, detail="Only PDF files are allowed")
+    await file.seek(0)
     filename = file.filename
     save_path = os.path.join(UPLOAD_DIR, filename)
-    with open(save_path, "wb") as f:
-        f.write(await file.read())
+    await asyncio.to_thread(save_upload, file.file, save_path)
+    await asyncio.to_thread(pdf_utils.invalidate_pdf_cache, save_path)
     return {"status": "uploaded", "filename": filename}
 
 @app.get("/get-page")
 def get_page(page: int, pdf_name: str):
     pdf_path = os.path.join(UPLOAD_DIR, pdf_name)
-    if not os.path.exists(pdf_path):
+    try:
+        data, media_type = pdf_utils.get_page_bytes(pdf_path, page)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="PDF not found")
+    return Response(content=data, media_type=media_type)
+
+@app.get("/prefetch-pages")
+async def prefetch_pages(pdf_name: str, pages: str) -> dict[str, Any]:
+    pdf_path = os.path.join(UPLOAD_DIR, pdf_name)
+    try:
+        page_nums = [int(p) for p in pages.split(",") if p.strip()]
+    except ValueError:
+        raise HTTPException(status_code=422, detail="pages must be a comma-separated list of page numbers")
+    # Every render queues on the single fitz thread ahead of interactive
+    # /get-page calls, so repeated and nonexistent pages are never queued
+    page_nums = list(dict.fromkeys(page_nums))
+    if len(page_nums) > MAX_PREFETCH_PAGES:
+        raise HTTPException(status_code=422, detail=f"At most {MAX_PREFETCH_PAGES} pages can be prefetched at once")
+    try:
+        page_count = await asyncio.to_thread(pdf_utils.get_page_count, pdf_path)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="PDF not found")
+    out_of_range = [p for p in page_nums if not 0 <= p < page_count]
+    page_nums = [p for p in page_nums if 0 <= p < page_count]
+
+    # Warm the page cache so the reader's next /get-page calls are hits
+    results = await asyncio.gather(*(warm_page(pdf_path, p) for p in page_nums), return_exceptions=True)
+    if any(isinstance(result, FileNotFoundError) for result in results):
         raise HTTPException(status_code=404, detail="PDF not found")
-    img = render_page(pdf_path, page)
-    _, im_buf_arr = cv2.imencode(".png", img)
-    return StreamingResponse(io.BytesIO(im_buf_arr.tobytes()), media_type="image/png")
+    warmed = [p for p, result in zip(page_nums, results) if not isinstance(result, Exception)]
+    return {"status": "prefetched", "pdf_name": pdf_name, "pages": warmed, "out_of_range": out_of_range}
+
+@app.post("/invalidate-cache")
+def invalidate_cache(pdf_name: str) -> dict[str, Any]:
+    pdf_path = os.path.join(UPLOAD_DIR, pdf_name)
+    dropped = pdf_utils.invalidate_pdf_cache(pdf_path)
+    return {"status": "invalidated", "pdf_name": pdf_name, "dropped_pages": dropped}
 
 @app.get("/get-total-pages")
-def get_total_pages(pdf_name: str):
+def get_total_pages(pdf_name: str) -> dict[str, Any]:
     pdf_path = os.path.join(UPLOAD_DIR, pdf_name)
-    if not os.path.exists(pdf_path):
+    try:
+        total_pages = pdf_utils.get_page_count(pdf_path)
+    except FileNotFoundError:
         raise HTTPException(status_code=404, detail="PDF not found")
-    doc = fitz.open(pdf_path)
-    total_pages = doc.page_count
-    doc.close()
     return {"total_pages": total_pages}
 
 @app.post("/save-crop/")
@@ -143,12 +359,14 @@ async def save_crop(
     subject_id: int = Form(...),
     course_id: int = Form(...),
     module_id: int = Form(...),
-    folder: str = Form(...)
-):
+    folder: str = Form(...),
+    db: Session = Depends(get_db)
+) -> dict[str, Any]:
     # print("Entered save_crop endpoint")
     try:
-        logger.info(f"Received request with: category={category}, page={page}, pdf_name={pdf_name}, "
-                    f"class_id={class_id}, subject_id={subject_id}, course_id={course_id}, module_id={module_id}, folder={folder}")
+        logger.info("Received request with: category=%s, page=%s, pdf_name=%s, "
+                    "class_id=%s, subject_id=%s, course_id=%s, module_id=%s, folder=%s",
+                    category, page, pdf_name, class_id, subject_id, course_id, module_id, folder)
 
         valid_categories = ["equations", "diagrams", "tables", "others"]
         if category not in valid_categories:
@@ -163,102 +381,33 @@ async def save_crop(
         image_bytes = await file.read()
         # print(f"Image bytes length: {len(image_bytes)}")
         
-        # Upload to S3
-        try:
-            s3_response = s3_utils.upload_to_s3(
+        # The S3 upload and the module-row upsert don't depend on each
+        # other, so they run concurrently; only the URL insert needs both.
+        # Each DB step commits (or rolls back) on its own worker thread.
+        s3_result, parent_result = await asyncio.gather(
+            asyncio.to_thread(
+                s3_utils.upload_to_s3,
                 file_data=image_bytes,
                 original_filename=f"{folder}/crop_{category}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.png",
                 bucket_name=S3_BUCKET_NAME
-            )
-            s3_url = s3_response["Location"]
-            # print(f"S3 upload successful, URL: {s3_url}")
-        except Exception as s3_error:
-            # print(f"S3 upload failed: {str(s3_error)}")
-            raise HTTPException(status_code=500, detail=f"S3 upload error: {str(s3_error)}")
+            ),
+            asyncio.to_thread(upsert_crop_parent, db, class_id, subject_id, course_id, module_id),
+            return_exceptions=True
+        )
+
+        if isinstance(s3_result, Exception):
+            raise HTTPException(status_code=500, detail=f"S3 upload error: {str(s3_result)}")
+        s3_url = s3_result["Location"]
 
-        db = SessionLocal()
         try:
-            # Use a more explicit approach with row locking
-            existing_record = db.query(PDFCropImages).filter(
-                PDFCropImages.class_id == class_id,
-                PDFCropImages.subject_id == subject_id,
-                PDFCropImages.course_id == course_id,
-                PDFCropImages.module_id == module_id
-            ).with_for_update().first()  # Add row-level locking
-
-            if existing_record:
-                logger.info(f"Updating existing record ID: {existing_record.id}")
-                
-                # Fetch fresh data from database to avoid stale data
-                db.refresh(existing_record)
-                
-                # Get current image_urls or initialize with default structure
-                current_image_urls = existing_record.image_urls or get_default_image_urls_structure()
-                
-                # Deep copy to ensure we're working with a new object
-                import copy
-                updated_image_urls = copy.deepcopy(current_image_urls)
-                
-                # Ensure the category exists in the structure
-                if category not in updated_image_urls:
-                    updated_image_urls[category] = []
-                
-                # Add new URL to the category
-                updated_image_urls[category].append(s3_url)
-                
-                print(f"Before update - Current URLs: {current_image_urls}")
-                print(f"After update - New URLs: {updated_image_urls}")
-                
-                # Update the record with the new structure
-                existing_record.image_urls = updated_image_urls
-                existing_record.updated_at = datetime.utcnow()
-                
-                # Force the ORM to recognize the change
-                from sqlalchemy.orm.attributes import flag_modified
-                flag_modified(existing_record, "image_urls")
-                
-            else:
-                logger.info(f"Creating new record for class_id={class_id}, subject_id={subject_id}, course_id={course_id}, module_id={module_id}")
-                
-                # Initialize the image_urls structure
-                image_urls_structure = get_default_image_urls_structure()
-                image_urls_structure[category].append(s3_url)
-                
-                new_entry = PDFCropImages(
-                    class_id=class_id,
-                    subject_id=subject_id,
-                    course_id=course_id,
-                    module_id=module_id,
-                    image_urls=image_urls_structure
-                )
-                db.add(new_entry)
-                # print(f"Created new record with structure: {image_urls_structure}")
-
-            # Explicit flush before commit
-            db.flush()
-            db.commit()
-            
-            # Verify the update was successful
-            verification_record = db.query(PDFCropImages).filter(
-                PDFCropImages.class_id == class_id,
-                PDFCropImages.subject_id == subject_id,
-                PDFCropImages.course_id == course_id,
-                PDFCropImages.module_id == module_id
-            ).first()
-            
-            if verification_record:
-                # print(f"Verification - Final image_urls: {verification_record.image_urls}")
-                logger.info(f"Successfully saved image with URL: {s3_url}")
-            else:
-                logger.error("Verification failed - record not found after commit")
-            
+            if isinstance(parent_result, Exception):
+                raise parent_result
+            await asyncio.to_thread(add_crop_url, db, parent_result, category, s3_url)
+            logger.info("Successfully saved image with URL: %s for record ID: %s", s3_url, parent_result)
         except Exception as db_error:
-            db.rollback()
             # print(f"Database error occurred: {str(db_error)}")
-            logger.error(f"Database commit failed: {str(db_error)}")
+            logger.error("Database commit failed: %s", db_error)
             raise HTTPException(status_code=500, detail=f"Database error: {str(db_error)}")
-        finally:
-            db.close()
 
         return {
             "status": "success", 
@@ -267,16 +416,15 @@ async def save_crop(
         }
 
     except HTTPException as e:
-        logger.error(f"HTTPException: {str(e.detail)}")
+        logger.error("HTTPException: %s", e.detail)
         raise e
     except Exception as e:
-        logger.error(f"Server error: {str(e)}")
+        logger.error("Server error: %s", e)
         raise HTTPException(status_code=500, detail=f"Server error: {str(e)}")
 
 
 @app.get("/get-images/")
-def get_images(class_id: int, subject_id: int, course_id: int, module_id: int):
-    db = SessionLocal()
+def get_images(class_id: int, subject_id: int, course_id: int, module_id: int, db: Session = Depends(get_db)) -> dict[str, Any]:
     try:
         record = db.query(PDFCropImages).filter(
             PDFCropImages.class_id == class_id,
@@ -286,10 +434,17 @@ def get_images(class_id: int, subject_id: int, course_id: int, module_id: int):
         ).first()
         
         if not record:
-            return get_default_image_urls_structure()
+            return {
+                "image_urls": get_default_image_urls_structure(),
+                "created_at": None,
+                "updated_at": None,
+                "total_images": 0
+            }
         
-        # Return the image_urls JSON structure
-        image_urls = record.image_urls or get_default_image_urls_structure()
+        rows = db.query(PDFCropURL.category, PDFCropURL.url).filter(
+            PDFCropURL.parent_id == record.id
+        ).order_by(PDFCropURL.id).all()
+        image_urls = merge_image_urls(record, rows)
         
         return {
             "image_urls": image_urls,
@@ -299,10 +454,8 @@ def get_images(class_id: int, subject_id: int, course_id: int, module_id: int):
         }
         
     except Exception as e:
-        logger.error(f"Error retrieving images: {str(e)}")
+        logger.error("Error retrieving images: %s", e)
         raise HTTPException(status_code=500, detail=f"Error retrieving images: {str(e)}")
-    finally:
-        db.close()
 
 # --- Endpoint to get images by specific category ---
 @app.get("/get-images-by-category/")
@@ -311,13 +464,13 @@ def get_images_by_category(
     subject_id: int, 
     course_id: int, 
     module_id: int, 
-    category: str
-):
+    category: str,
+    db: Session = Depends(get_db)
+) -> dict[str, Any]:
     valid_categories = ["equations", "diagrams", "tables", "others"]
     if category not in valid_categories:
         raise HTTPException(status_code=422, detail=f"Invalid category. Must be one of {valid_categories}")
     
-    db = SessionLocal()
     try:
         record = db.query(PDFCropImages).filter(
             PDFCropImages.class_id == class_id,
@@ -326,16 +479,20 @@ def get_images_by_category(
             PDFCropImages.module_id == module_id
         ).first()
         
-        if not record or not record.image_urls:
-            return {category: []}
+        if not record:
+            return {category: [], "count": 0}
+        
+        urls = list((record.image_urls or {}).get(category, []))
+        urls.extend(url for (url,) in db.query(PDFCropURL.url).filter(
+            PDFCropURL.parent_id == record.id,
+            PDFCropURL.category == category
+        ).order_by(PDFCropURL.id))
         
         return {
-            category: record.image_urls.get(category, []),
-            "count": len(record.image_urls.get(category, []))
+            category: urls,
+            "count": len(urls)
         }
         
     except Exception as e:
-        logger.error(f"Error retrieving images by category: {str(e)}")
-        raise HTTPException(status_code=500, detail=f"Error retrieving images: {str(e)}")
-    finally:
-        db.close()
\ No newline at end of file
+        logger.error("Error retrieving images by category: %s", e)
+        raise HTTPException(status_code=500, detail=f"Error retrieving images: {str(e)}")
\ No newline at end of file
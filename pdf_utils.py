@@ -0,0 +1,253 @@
+# pdf_utils.py
+import fitz
+import numpy as np
+import cv2
+import os
+import io
+import threading
+from PIL import Image
+from collections import OrderedDict
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+
+# Pages are only displayed by the client, so a quality-85 JPEG is plenty for
+# photographic pages and much cheaper to produce than a full-color PNG.
+JPEG_QUALITY = 85
+PALETTE_COLORS = 128
+
+# In-memory LRU of encoded pages, keyed by (pdf_path, mtime, page, zoom).
+# Including the mtime means a replaced PDF can never be served stale.
+# Encoded pages run from ~40 KB to over 1 MB, so the LRU is bounded by total
+# bytes as well as by entry count to stay within a small instance's memory.
+PAGE_CACHE_SIZE = 500
+PAGE_CACHE_BYTES = 128 << 20
+_page_cache = OrderedDict()
+_page_cache_bytes = 0
+_page_cache_lock = threading.Lock()
+
+# MuPDF is not thread-safe: besides a Document, its global store (fonts,
+# images, the tile cache shrunk by store_shrink) is shared by every render
+# without locking. All fitz work therefore runs on one dedicated thread, so
+# at most one page renders at a time whatever the number of request threads;
+# pixels are copied off that thread and encoded by the callers in parallel.
+_fitz_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="fitz")
+
+
+def _run_fitz(fn, *args):
+    """Runs fn on the fitz thread and waits for its result"""
+    return _fitz_executor.submit(fn, *args).result()
+
+
+# Open fitz.Document handles (CachedDoc), keyed by pdf_path and holding the
+# mtime they were opened at; only touched from the fitz thread. Each entry
+# also keeps a small LRU of loaded page objects, which retain their parsed
+# content streams; it is kept small because pages also pin fonts and images.
+DOC_CACHE_SIZE = 16
+PAGE_OBJECT_CACHE_SIZE = 8
+_doc_cache = OrderedDict()
+
+
+class CachedDoc:
+    """An open fitz.Document with its page LRU"""
+
+    def __init__(self, mtime, doc):
+        self.mtime = mtime
+        self.doc = doc
+        self.pages = OrderedDict()
+
+    def close(self):
+        self.pages.clear()
+        self.doc.close()
+
+
+def _close_docs(entries):
+    """Closes evicted CachedDoc entries and releases MuPDF's caches"""
+    for entry in entries:
+        entry.close()
+    if entries:
+        fitz.TOOLS.store_shrink(100)
+
+
+def _get_doc(pdf_path, mtime):
+    """Returns the cached CachedDoc for pdf_path, opening the PDF on a miss"""
+    # Raises FileNotFoundError for a missing PDF
+    entry = _doc_cache.get(pdf_path)
+    if entry is not None and entry.mtime == mtime:
+        _doc_cache.move_to_end(pdf_path)
+        return entry
+    evicted = [entry] if entry is not None else []
+    entry = _doc_cache[pdf_path] = CachedDoc(mtime, fitz.open(pdf_path))
+    _doc_cache.move_to_end(pdf_path)
+    while len(_doc_cache) > DOC_CACHE_SIZE:
+        evicted.append(_doc_cache.popitem(last=False)[1])
+    _close_docs(evicted)
+    return entry
+
+
+def _page_count(pdf_path):
+    return _get_doc(pdf_path, os.path.getmtime(pdf_path)).doc.page_count
+
+
+def get_page_count(pdf_path):
+    """Returns the number of pages in a PDF"""
+    return _run_fitz(_page_count, pdf_path)
+
+
+def load_page(doc, pages, page_num):
+    """Returns a page object via the doc's page LRU; runs on the fitz thread"""
+    page = pages.get(page_num)
+    if page is not None:
+        pages.move_to_end(page_num)
+        return page
+    page = doc.load_page(page_num)
+    pages[page_num] = page
+    while len(pages) > PAGE_OBJECT_CACHE_SIZE:
+        pages.popitem(last=False)
+    return page
+
+
+@lru_cache(maxsize=8)
+def zoom_matrix(zoom):
+    """Returns a shared fitz.Matrix for a zoom level; callers must not mutate it"""
+    return fitz.Matrix(zoom, zoom)
+
+
+def _is_neutral(rgb):
+    return max(rgb) - min(rgb) < 0.01
+
+
+def classify_page(page):
+    """Returns (has_images, is_grayscale) for a page"""
+    if page.get_images():
+        return True, False
+    blocks = page.get_text("dict")["blocks"]
+    if any(block["type"] != 0 for block in blocks):
+        # Inline images do not show up in get_images()
+        return True, False
+    grayscale = True
+    for block in blocks:
+        for line in block["lines"]:
+            for span in line["spans"]:
+                color = span["color"]
+                if not _is_neutral(((color >> 16) & 0xFF, (color >> 8) & 0xFF, color & 0xFF)):
+                    grayscale = False
+    if grayscale:
+        for path in page.get_drawings():
+            for key in ("color", "fill"):
+                if path.get(key) and not _is_neutral(path[key]):
+                    grayscale = False
+    return False, grayscale
+
+
+def render_page(doc, pages, page_num, zoom=2):
+    """Renders a page, returns (pixmap, has_images); runs on the fitz thread"""
+    page = load_page(doc, pages, page_num)
+    has_images, grayscale = classify_page(page)
+    # One byte per pixel instead of three for plain text/line-art pages
+    colorspace = fitz.csGRAY if grayscale else fitz.csRGB
+    # annots=False skips the annotation appearance pass; the reader only
+    # shows page content
+    pix = page.get_pixmap(matrix=zoom_matrix(zoom), alpha=False, colorspace=colorspace, annots=False)
+    return pix, has_images
+
+
+def _render_samples(pdf_path, mtime, page_num, zoom):
+    """Renders a page on the fitz thread, returns (samples, has_images)"""
+    entry = _get_doc(pdf_path, mtime)
+    pix, has_images = render_page(entry.doc, entry.pages, page_num, zoom)
+    # Copy the pixels into an (h, w, n) array so the pixmap is dropped here,
+    # on the fitz thread; the copy is a couple of ms next to a 10+ ms encode
+    samples = np.frombuffer(pix.samples_mv, dtype=np.uint8).reshape(pix.height, pix.width, pix.n).copy()
+    return samples, has_images
+
+
+def _has_few_colors(img):
+    """True when a nearest-neighbour sample of every 4th pixel fits the palette"""
+    sample = img.resize((max(1, img.width // 4), max(1, img.height // 4)), Image.Resampling.NEAREST)
+    return sample.getcolors(PALETTE_COLORS) is not None
+
+
+def encode_page(samples, has_images):
+    """Encodes an (h, w, n) page array, returns (buffer, media_type)"""
+    # Grayscale text/line-art pages go out as 8-bit PNG: about 3x the encode
+    # time of JPEG (~30 ms vs ~10 ms for a dense 1190x1684 page) but over 10x
+    # smaller, and pages are cached once encoded. Color pages are only
+    # palettized when a sample shows few colors; quantizing costs 30-40 ms,
+    # and anti-aliased color text never fits a small palette anyway, so
+    # everything else, and anything with images, goes out as JPEG.
+    if not has_images:
+        grayscale = samples.shape[2] == 1
+        img = Image.fromarray(samples.reshape(samples.shape[:2]) if grayscale else samples)
+        if grayscale or _has_few_colors(img):
+            if not grayscale:
+                img = img.quantize(colors=PALETTE_COLORS, method=Image.Quantize.FASTOCTREE)
+            buf = io.BytesIO()
+            img.save(buf, "PNG", optimize=False, compress_level=1)
+            return buf.getbuffer(), "image/png"
+
+    img = samples
+    if img.shape[2] == 3:
+        img = cv2.cvtColor(img, cv2.COLOR_RGB2BGR)
+    ok, im_buf_arr = cv2.imencode(".jpg", img, [cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY])
+    if not ok:
+        raise RuntimeError("Failed to encode page")
+    # Hand out a flat view of the encoder's buffer rather than copying it
+    return memoryview(im_buf_arr).cast("B"), "image/jpeg"
+
+
+def get_page_bytes(pdf_path, page_num, zoom=2):
+    """Returns (buffer, media_type) for a page, rendering it only on a cache miss"""
+    mtime = os.path.getmtime(pdf_path)
+    key = (pdf_path, mtime, page_num, zoom)
+    with _page_cache_lock:
+        data = _page_cache.get(key)
+        if data is not None:
+            _page_cache.move_to_end(key)
+            return data
+
+    samples, has_images = _run_fitz(_render_samples, pdf_path, mtime, page_num, zoom)
+    data = encode_page(samples, has_images)
+    _store_page(key, data)
+    return data
+
+
+def _store_page(key, data):
+    """Adds an encoded page to the LRU, evicting by count and byte budget"""
+    global _page_cache_bytes
+    with _page_cache_lock:
+        previous = _page_cache.pop(key, None)
+        if previous is not None:
+            _page_cache_bytes -= len(previous[0])
+        _page_cache[key] = data
+        _page_cache_bytes += len(data[0])
+        while len(_page_cache) > PAGE_CACHE_SIZE or _page_cache_bytes > PAGE_CACHE_BYTES:
+            _, (evicted, _) = _page_cache.popitem(last=False)
+            _page_cache_bytes -= len(evicted)
+
+
+def invalidate_pdf_cache(pdf_path):
+    """Drops the cached pages and doc handle of the given PDF, returns how many pages were dropped"""
+    global _page_cache_bytes
+    with _page_cache_lock:
+        stale = [key for key in _page_cache if key[0] == pdf_path]
+        for key in stale:
+            _page_cache_bytes -= len(_page_cache.pop(key)[0])
+    _run_fitz(_drop_doc, pdf_path)
+    return len(stale)
+
+
+def _drop_doc(pdf_path):
+    entry = _doc_cache.pop(pdf_path, None)
+    if entry is not None:
+        _close_docs([entry])
+
+
+def close_all_docs():
+    """Closes every cached document, e.g. on shutdown"""
+    _run_fitz(_close_all)
+
+
+def _close_all():
+    entries = list(_doc_cache.values())
+    _doc_cache.clear()
+    _close_docs(entries)
@@ -2,46 +2,70 @@
 import boto3
 import os
 import time
+import uuid
 import mimetypes
 import io
+import logging
+from functools import lru_cache
 from botocore.exceptions import BotoCoreError, ClientError
 
+logger = logging.getLogger(__name__)
+
+MULTIPART_THRESHOLD = 8 << 20
+
+
+@lru_cache(maxsize=None)
+def get_s3_client():
+    # boto3 clients are thread-safe; building one per call repeats credential
+    # resolution and the TLS handshake, so share a single client.
+    return boto3.client(
+        "s3",
+        aws_access_key_id=os.getenv("S3_BUCKET_ACCESS_KEY"),
+        aws_secret_access_key=os.getenv("S3_BUCKET_SECRET_KEY"),
+    )
+
 
 def upload_to_s3(file_data: bytes, original_filename: str, bucket_name: str):
     try:
-        s3 = boto3.client(
-            "s3",
-            aws_access_key_id=os.getenv("S3_BUCKET_ACCESS_KEY"),
-            aws_secret_access_key=os.getenv("S3_BUCKET_SECRET_KEY"),
-        )
+        s3 = get_s3_client()
 
         # Determine file extension
         file_extension = mimetypes.guess_extension(mimetypes.guess_type(original_filename)[0]) or '.webp'
-        new_file_name = f"file_{int(time.time())}{file_extension}"
+        # A uuid suffix keeps keys unique without listing the bucket; a bare
+        # timestamp collides when two crops are saved in the same second.
+        new_file_name = f"file_{int(time.time())}_{uuid.uuid4().hex}{file_extension}"
 
-        # Upload file to S3
-        s3.upload_fileobj(
-            Fileobj=io.BytesIO(file_data),
-            Bucket=bucket_name,
-            Key=new_file_name
-        )
+        content_type = mimetypes.guess_type(new_file_name)[0] or "application/octet-stream"
+
+        # Upload file to S3. Crops are small, so a single PUT beats the
+        # threaded multipart transfer manager; keep that only for big files.
+        if len(file_data) > MULTIPART_THRESHOLD:
+            s3.upload_fileobj(
+                Fileobj=io.BytesIO(file_data),
+                Bucket=bucket_name,
+                Key=new_file_name,
+                ExtraArgs={"ContentType": content_type}
+            )
+        else:
+            s3.put_object(
+                Body=file_data,
+                Bucket=bucket_name,
+                Key=new_file_name,
+                ContentType=content_type
+            )
 
         # Return the S3 URL
         s3_url = f"https://{bucket_name}.s3.amazonaws.com/{new_file_name}"
         return {"Location": s3_url, "Key": new_file_name}
 
     except (BotoCoreError, ClientError) as e:
-        print(f"S3 Upload Error: {e}")
+        logger.error("S3 Upload Error: %s", e)
         raise e
 
 
 def generate_signed_url(file_name: str, bucket_name: str, expiration: int = 60):
     try:
-        s3 = boto3.client(
-            "s3",
-            aws_access_key_id=os.getenv("S3_BUCKET_ACCESS_KEY"),
-            aws_secret_access_key=os.getenv("S3_BUCKET_SECRET_KEY"),
-        )
+        s3 = get_s3_client()
 
         url = s3.generate_presigned_url(
             ClientMethod='get_object',
@@ -54,5 +78,5 @@ def generate_signed_url(file_name: str, bucket_name: str, expiration: int = 60):
         return url
 
     except Exception as e:
-        print(f"S3 Signed URL Error: {e}")
+        logger.error("S3 Signed URL Error: %s", e)
         return None